@@ -2,9 +2,13 @@ import io
 import os
 import re
 import time
+import shutil
+import signal
+import tempfile
+import numpy as np
 import board
 import neopixel
-import digitalio
+from gpiozero import Button
 from picamera import PiCamera
 import threading
 import subprocess
@@ -15,12 +19,20 @@ BUTTON_PIN = board.D27
 NUM_PIXELS = 92
 PIXEL_ORDER = neopixel.GRB
 
+# Commands used to force the display on and off around raspistill
+CHVT_6_CMD = ["chvt", "6"]
+CHVT_7_CMD = ["chvt", "7"]
+DISPLAY_OFF_CMD = ["tvservice", "-p"]
+
+# How long to wait for the resident raspistill to write a photo
+CAPTURE_TIMEOUT = 10
+# How long to wait for raspistill to start a photo before signalling it again,
+# it ignores the signal until it has finished setting up the camera
+CAPTURE_SIGNAL_RETRY = 1
+
+EXPOSURE_RE = re.compile(r"mmal: Exposure now (?P<exposure>[0-9]*), analog gain (?P<analog_gain_n>[0-9]*)/(?P<analog_gain_d>[0-9]*), digital gain (?P<digital_gain_n>[0-9]*)/(?P<digital_gain_d>[0-9]*)", re.MULTILINE)
+AWB_RE = re.compile(r"mmal: AWB R=(?P<awb_r_n>[0-9]*)/(?P<awb_r_d>[0-9]*), B=(?P<awb_b_n>[0-9]*)/(?P<awb_b_d>[0-9]*)", re.MULTILINE)
 
-def find_last_match(pattern, string):
-    matches = re.finditer(pattern, string, re.MULTILINE)
-    if matches:
-        return list(matches)[-1]
-    return None
 
 class PixelArray(object):
     FLASH_BRIGHTNESS = 0.2
@@ -29,90 +41,106 @@ class PixelArray(object):
     def __init__(self, pin, num_pixels, pixel_order):
         self.num_pixels = num_pixels
         self.pixel_order = pixel_order
+        # Set while the flash owns the pixels, the idle animation doesn't draw then.
+        # The lock is only held while the animation writes a frame.
+        self.flash_active = threading.Event()
         self.lock = threading.Lock()
-        self.pixels = neopixel.NeoPixel(pin, num_pixels, brightness=PixelArray.IDLE_BRIGHTNESS,
+        # Colors are scaled to the wanted brightness up front, the library's own
+        # brightness scaling copies and scales the whole buffer on every show()
+        self.pixels = neopixel.NeoPixel(pin, num_pixels, brightness=1.0,
                                         auto_write=False, pixel_order=pixel_order)
+        self.countdown_color = PixelArray.scale((255, 0, 0), PixelArray.FLASH_BRIGHTNESS)
+        self.flash_color = PixelArray.scale((255, 255, 255), PixelArray.FLASH_BRIGHTNESS)
+
+    @staticmethod
+    def scale(color, brightness):
+        return tuple(int(c * brightness) for c in color)
 
     def destroy(self):
         self.pixels.deinit()
 
     def flash_on(self, countdown=True):
-        self.lock.acquire()
-        self.pixels.brightness = PixelArray.FLASH_BRIGHTNESS
+        # Taking the lock waits for a frame that is being drawn to finish
+        with self.lock:
+            self.flash_active.set()
 
         if countdown:
             for i in range(3):
-                self.pixels.fill((255, 0, 0))
+                self.pixels.fill(self.countdown_color)
                 self.pixels.show()
                 time.sleep(0.5)
                 self.pixels.fill((0, 0, 0))
                 self.pixels.show()
                 time.sleep(1)
 
-        self.pixels.fill((255, 255, 255))
+        self.pixels.fill(self.flash_color)
         self.pixels.show()
 
     def flash_off(self):
-        self.pixels.brightness = PixelArray.IDLE_BRIGHTNESS
         self.pixels.fill((0, 0, 0))
         self.pixels.show()
-        self.lock.release()
+        self.flash_active.clear()
 
 class IdleAnimation(threading.Thread):
+    # Pause between frames so the animation doesn't keep the pixel lock and the bus busy
+    FRAME_INTERVAL = 0.005
+    # How often to check whether the flash has finished
+    FLASH_POLL_INTERVAL = 0.05
+
     def __init__(self, pixel_array):
         super(IdleAnimation, self).__init__()
         self.pixel_array = pixel_array
-        self.running = False
+        self.stop_event = threading.Event()
+
+        # Color wheel lookup table: the colours are a transition r - g - b - back to r.
+        bpp = 3 if pixel_array.pixel_order == neopixel.RGB or pixel_array.pixel_order == neopixel.GRB else 4
+        pos = np.arange(256, dtype=np.int32)
+        self.wheel_lut = np.zeros((256, bpp), dtype=np.uint8)
+        p = pos[:85]
+        self.wheel_lut[:85, 0] = p * 3
+        self.wheel_lut[:85, 1] = 255 - p * 3
+        p = pos[85:170] - 85
+        self.wheel_lut[85:170, 0] = 255 - p * 3
+        self.wheel_lut[85:170, 2] = p * 3
+        p = pos[170:] - 170
+        self.wheel_lut[170:, 1] = p * 3
+        self.wheel_lut[170:, 2] = 255 - p * 3
+        self.wheel_lut = (self.wheel_lut * PixelArray.IDLE_BRIGHTNESS).astype(np.uint8)
+
+        # Wheel position of each pixel at the start of the animation
+        self.pixel_offsets = np.arange(pixel_array.num_pixels) * 256 // pixel_array.num_pixels
 
     def stop(self):
-        if self.running:
-            self.running = False
+        if self.is_alive():
+            self.stop_event.set()
             self.join()
 
     def run(self):
-        self.running = True
-        def wheel(pos):
-            # Input a value 0 to 255 to get a color value.
-            # The colours are a transition r - g - b - back to r.
-            if pos < 0 or pos > 255:
-                r = g = b = 0
-            elif pos < 85:
-                r = int(pos * 3)
-                g = int(255 - pos*3)
-                b = 0
-            elif pos < 170:
-                pos -= 85
-                r = int(255 - pos*3)
-                g = 0
-                b = int(pos*3)
-            else:
-                pos -= 170
-                r = 0
-                g = int(pos*3)
-                b = int(255 - pos*3)
-            return (r, g, b) if self.pixel_array.pixel_order == neopixel.RGB or self.pixel_array.pixel_order == neopixel.GRB else (r, g, b, 0)
-
         while True:
             for j in range(255):
-                if not self.running:
-                    return None
-
+                if self.pixel_array.flash_active.is_set():
+                    if self.stop_event.wait(IdleAnimation.FLASH_POLL_INTERVAL):
+                        return None
+                    continue
+
+                # Compute the frame outside the lock so it is only held for the write
+                # The slice write takes the whole list of [r, g, b] values at once
+                frame = self.wheel_lut[(self.pixel_offsets + j) & 255].tolist()
                 with self.pixel_array.lock:
-                    for i in range(self.pixel_array.num_pixels):
-                        pixel_index = (i * 256 // self.pixel_array.num_pixels) + j
-                        pixel_values = wheel(pixel_index & 255)
-                        self.pixel_array.pixels[i] = pixel_values
-                    self.pixel_array.pixels.show()
+                    if not self.pixel_array.flash_active.is_set():
+                        self.pixel_array.pixels[:] = frame
+                        self.pixel_array.pixels.show()
+
+                if self.stop_event.wait(IdleAnimation.FRAME_INTERVAL):
+                    return None
 
 class BigButton(object):
     def __init__(self, pin):
-        self.button = digitalio.DigitalInOut(pin)
-        self.button.direction = digitalio.Direction.INPUT
-        self.button.pull = digitalio.Pull.UP
+        # gpiozero waits for the edge interrupt instead of polling the pin
+        self.button = Button(pin.id, pull_up=True)
 
     def wait_for_press(self):
-        while self.button.value:
-            time.sleep(0.02)
+        self.button.wait_for_press()
 
 class Camera(object):
     SETTINGS_UPDATE_INTERVAL = 10 * 60
@@ -123,29 +151,42 @@ class Camera(object):
         self.settings_lock = threading.Lock()
         self.update_settings()
 
+        self.stop_event = threading.Event()
+        self.settings_update_thread = threading.Thread(target=self.settings_update_loop, daemon=True)
+        self.settings_update_thread.start()
+
     def destroy(self):
-        self.settings_update_timer.cancel()
+        self.stop_event.set()
+        self.settings_update_thread.join()
+
+    def settings_update_loop(self):
+        while not self.stop_event.wait(Camera.SETTINGS_UPDATE_INTERVAL):
+            try:
+                self.update_settings()
+            except Exception as e:
+                print("Updating settings failed:", e)
 
     def update_settings(self):
         print("Updating settings...")
         with self.settings_lock:
             self.pixel_array.flash_on(countdown=False)
-            self.settings = self.update_capture_settings()
-            self.pixel_array.flash_off()
+            try:
+                self.settings = self.update_capture_settings()
+            finally:
+                self.pixel_array.flash_off()
 
         print("  Analog gain:", self.settings['analog_gain'])
         print("  Digital gain:", self.settings['digital_gain'])
         print("  Shutter speed:", self.settings['shutter_speed'])
         print("  AWB gains:", self.settings['awb_gains'])
 
-        self.settings_update_timer = threading.Timer(Camera.SETTINGS_UPDATE_INTERVAL, self.update_settings)
-        self.settings_update_timer.start()
-
     def take_photo(self, output_path):
         with self.settings_lock:
             self.pixel_array.flash_on()
-            self.capture_image(output_path)
-            self.pixel_array.flash_off()
+            try:
+                self.capture_image(output_path)
+            finally:
+                self.pixel_array.flash_off()
 
     def update_capture_settings(self):
         raise Exception()
@@ -154,48 +195,122 @@ class Camera(object):
         raise Exception()
 
 class PyCamera(Camera):
+    def __init__(self, resolution, pixel_array):
+        # Keep one camera open, opening it initializes the whole sensor pipeline
+        self.camera = PiCamera(resolution=resolution)
+        super(PyCamera, self).__init__(resolution, pixel_array)
+
+    def destroy(self):
+        super(PyCamera, self).destroy()
+        self.camera.close()
+
     def update_capture_settings(self):
         settings = {
             'analog_gain': None,
             'digital_gain': None,
         }
-        with PiCamera(resolution=self.resolution) as camera:
-            # Wait for the automatic gain control to settle
-            time.sleep(2)
+        # Undo the fixed settings from the last capture
+        self.camera.shutter_speed = 0
+        self.camera.exposure_mode = 'auto'
+        self.camera.awb_mode = 'auto'
+
+        # Wait for the automatic gain control to settle
+        time.sleep(2)
 
-            # Now save the values
-            settings['shutter_speed'] = camera.exposure_speed
-            settings['awb_gains'] = [float(g) for g in camera.awb_gains]
+        # Now save the values
+        settings['shutter_speed'] = self.camera.exposure_speed
+        settings['awb_gains'] = [float(g) for g in self.camera.awb_gains]
         return settings
 
     def capture_image(self, output_path):
-        with PiCamera(resolution=self.resolution) as camera:
-            camera.exposure_mode = 'off'
-            camera.shutter_speed = self.settings['shutter_speed']
-            camera.awb_mode = 'off'
-            camera.awb_gains = self.settings['awb_gains']
-            camera.capture(output_path)
-        
+        self.camera.exposure_mode = 'off'
+        self.camera.shutter_speed = self.settings['shutter_speed']
+        self.camera.awb_mode = 'off'
+        self.camera.awb_gains = self.settings['awb_gains']
+        self.camera.capture(output_path)
+
 class RaspiStillCamera(Camera):
-    def update_capture_settings(self):
-        cmd = ["raspistill",
-               "--width", str(self.resolution[0]),
-               "--height", str(self.resolution[1]),
-               "--nopreview",
-               "--settings"]
+    def __init__(self, resolution, pixel_array):
+        # raspistill is kept running in signal mode and takes a photo on every
+        # SIGUSR1, writing it into this directory
+        self.capture_dir = tempfile.mkdtemp(prefix='raspistill-')
+        self.raspistill = None
+
+        # The parts of the raspistill command lines that never change
+        self.settings_cmd = ["raspistill",
+                             "--width", str(resolution[0]),
+                             "--height", str(resolution[1]),
+                             "--nopreview",
+                             "--settings"]
+        self.capture_cmd = ["raspistill",
+                            "--output", os.path.join(self.capture_dir, "capture-%04d.jpg"),
+                            "--thumb", "none",
+                            "--width", str(resolution[0]),
+                            "--height", str(resolution[1]),
+                            "--exposure", "off",
+                            "--awb", "off",
+                            "--signal",
+                            "--timeout", "0",
+                            "--nopreview"]
+        super(RaspiStillCamera, self).__init__(resolution, pixel_array)
 
+    def destroy(self):
+        super(RaspiStillCamera, self).destroy()
+        self.stop_raspistill()
+        shutil.rmtree(self.capture_dir, ignore_errors=True)
+
+    def start_raspistill(self, settings):
+        self.raspistill = subprocess.Popen(self.capture_cmd + [
+            "--analoggain", str(settings['analog_gain']),
+            "--digitalgain", str(settings['digital_gain']),
+            "--shutter", str(settings['shutter_speed']),
+            "--awbgains", ",".join([str(g) for g in settings['awb_gains']])])
+
+    def stop_raspistill(self):
+        if self.raspistill is not None:
+            self.raspistill.terminate()
+            self.raspistill.wait()
+            self.raspistill = None
 
-        # raspistill hangs if the display is off, so force it on by changing virtual terminals
-        subprocess.call("chvt 6", shell=True)
-        subprocess.call("chvt 7", shell=True)
+    def update_capture_settings(self):
+        # only one raspistill can use the camera at a time
+        self.stop_raspistill()
+        settings = None
+        try:
+            settings = self.measure_settings()
+        finally:
+            # if measuring failed keep taking photos with the previous settings
+            if settings is not None:
+                self.start_raspistill(settings)
+            elif hasattr(self, 'settings'):
+                self.start_raspistill(self.settings)
+        return settings
 
-        result = subprocess.run(cmd, stderr=subprocess.PIPE)
+    def measure_settings(self):
+        # raspistill hangs if the display is off, so force it on by changing virtual terminals
+        subprocess.call(CHVT_6_CMD)
+        subprocess.call(CHVT_7_CMD)
+
+        # the settled values are the last ones logged, so only keep the latest
+        # exposure and AWB lines as the log streams in
+        exposure_line = awb_line = b""
+        with subprocess.Popen(self.settings_cmd, stderr=subprocess.PIPE) as settings_process:
+            for line in settings_process.stderr:
+                if b"mmal: Exposure now" in line:
+                    exposure_line = line
+                elif b"mmal: AWB R=" in line:
+                    awb_line = line
 
         # turn display back off
-        subprocess.call("tvservice -p", shell=True)
+        subprocess.call(DISPLAY_OFF_CMD)
+
+        if settings_process.returncode != 0:
+            raise Exception("raspistill --settings exited with status %d" % settings_process.returncode)
 
-        m1 = find_last_match("mmal: Exposure now (?P<exposure>[0-9]*), analog gain (?P<analog_gain_n>[0-9]*)/(?P<analog_gain_d>[0-9]*), digital gain (?P<digital_gain_n>[0-9]*)/(?P<digital_gain_d>[0-9]*)", str(result.stderr))
-        m2 = find_last_match("mmal: AWB R=(?P<awb_r_n>[0-9]*)/(?P<awb_r_d>[0-9]*), B=(?P<awb_b_n>[0-9]*)/(?P<awb_b_d>[0-9]*)", str(result.stderr))
+        m1 = EXPOSURE_RE.search(exposure_line.decode('ascii', errors='replace'))
+        m2 = AWB_RE.search(awb_line.decode('ascii', errors='replace'))
+        if m1 is None or m2 is None:
+            raise Exception("raspistill --settings did not log the exposure and AWB settings")
 
         settings = {
             'analog_gain': float(m1.group('analog_gain_n')) / float(m1.group('analog_gain_d')),
@@ -210,20 +325,36 @@ class RaspiStillCamera(Camera):
         return settings
 
     def capture_image(self, output_path):
-        subprocess.call(["raspistill",
-                         "--output", output_path,
-                         "--thumb", "none",
-                         "--width", str(self.resolution[0]),
-                         "--height", str(self.resolution[1]),
-                         "--analoggain", str(self.settings['analog_gain']),
-                         "--digitalgain", str(self.settings['digital_gain']),
-                         "--exposure", "off",
-                         "--shutter", str(self.settings['shutter_speed']),
-                         "--awb", "off",
-                         "--awbgains", ",".join([str(g) for g in self.settings['awb_gains']]),
-                         "--timeout", "1",
-                         "--nopreview",
-                         "--verbose"])
+        # drop anything left over from an earlier capture that timed out
+        for name in os.listdir(self.capture_dir):
+            try:
+                os.remove(os.path.join(self.capture_dir, name))
+            except FileNotFoundError:
+                pass
+
+        deadline = time.time() + CAPTURE_TIMEOUT
+        while time.time() < deadline:
+            if self.raspistill is None or self.raspistill.poll() is not None:
+                # SIGUSR1 kills raspistill until it has started, so give it time first
+                self.start_raspistill(self.settings)
+                time.sleep(CAPTURE_SIGNAL_RETRY)
+                continue
+            os.kill(self.raspistill.pid, signal.SIGUSR1)
+
+            # raspistill writes to "<name>~" and renames it once the photo is complete
+            retry = min(time.time() + CAPTURE_SIGNAL_RETRY, deadline)
+            started = False
+            while time.time() < retry or (started and time.time() < deadline):
+                names = os.listdir(self.capture_dir)
+                for name in names:
+                    if not name.endswith('~'):
+                        # Rename into place so the photo shows up in one piece, like raspistill does
+                        shutil.move(os.path.join(self.capture_dir, name), output_path + '~')
+                        os.rename(output_path + '~', output_path)
+                        return
+                started = len(names) > 0
+                time.sleep(0.02)
+        raise Exception("raspistill did not write a photo")
 
 if __name__ == '__main__':
     cur_dir = os.path.dirname(os.path.realpath(__file__))
@@ -243,7 +374,10 @@ if __name__ == '__main__':
             #time.sleep(5)
 
             print("Taking a photo")
-            camera.take_photo(os.path.join(cur_dir, 'photos', 'photo-%f.jpg' % time.time()))
+            try:
+                camera.take_photo(os.path.join(cur_dir, 'photos', 'photo-%f.jpg' % time.time()))
+            except Exception as e:
+                print("Taking a photo failed:", e)
 
     finally:
         if camera:
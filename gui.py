@@ -2,42 +2,73 @@ import os
 import time
 import tkinter as tk
 import signal
+from concurrent.futures import ThreadPoolExecutor
 from PIL import ImageTk, Image
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 import subprocess
 
 PHOTO_DISPLAY_TIMEOUT = 5 * 60 * 1000
+PHOTO_EVENT_DEBOUNCE = 0.2
+PHOTO_SIZE = (951, 1268)
+DISPLAY_ON_CMD = ["xset", "-display", ":0.0", "dpms", "force", "on"]
+DISPLAY_OFF_CMD = ["tvservice", "-p"]
 
 class Handler(FileSystemEventHandler):
-    def on_any_event(self, event):
-        path = event.dest_path if event.event_type == 'moved' else event.src_path
-        self.handle_event(path)
+    def __init__(self):
+        super(Handler, self).__init__()
+        self.last_path = None
+        self.last_time = 0
+        # Photos are decoded off the watchdog and Tk threads
+        self.decoder = ThreadPoolExecutor(max_workers=1)
+
+    # Only react once a photo is complete, either written in place or renamed into the directory
+    def on_closed(self, event):
+        self.handle_event(event.src_path)
+
+    def on_moved(self, event):
+        self.handle_event(event.dest_path)
 
     def handle_event(self, path):
         if not path.endswith('.jpg'):
             return
 
+        # Ignore repeated events for a photo that was just displayed
+        now = time.monotonic()
+        if path == self.last_path and now - self.last_time < PHOTO_EVENT_DEBOUNCE:
+            return
+        self.last_path = path
+        self.last_time = now
+
+        self.decoder.submit(self.load_photo, path)
+
+    def load_photo(self, path):
         try:
-            photo = ImageTk.PhotoImage(Image.open(path))
-            insta_photo.configure(image=photo)
-            insta_photo.image = photo
-            display_on()
-            global display_off_task
-            if display_off_task is not None:
-                root.after_cancel(display_off_task)
-            display_off_task = root.after(PHOTO_DISPLAY_TIMEOUT, display_off)
+            img = Image.open(path)
+            # Let libjpeg decode at the display size instead of decoding everything and scaling after
+            img.draft('RGB', PHOTO_SIZE)
+            img.load()
+            if img.size != PHOTO_SIZE:
+                img = img.resize(PHOTO_SIZE)
         except:
-            pass
+            return
+        root.after(0, show_photo, img)
 
-def check():
-    root.after(50, check)
+def show_photo(img):
+    photo = ImageTk.PhotoImage(img)
+    insta_photo.configure(image=photo)
+    insta_photo.image = photo
+    display_on()
+    global display_off_task
+    if display_off_task is not None:
+        root.after_cancel(display_off_task)
+    display_off_task = root.after(PHOTO_DISPLAY_TIMEOUT, display_off)
 
 def display_on():
-    subprocess.call("xset -display :0.0 dpms force on", shell=True)
+    subprocess.call(DISPLAY_ON_CMD)
 
 def display_off():
-    subprocess.call("tvservice -p", shell=True)
+    subprocess.call(DISPLAY_OFF_CMD)
     global display_off_task
     display_off_task = None
 
@@ -50,14 +81,21 @@ if __name__ == '__main__':
     root=tk.Tk()
     root.wm_attributes('-fullscreen','true')
     root.config(cursor="none")
-    root.after(500, check)
+
+    # Quit on Ctrl+C. Tk blocks in its event loop, so have the signal write to a
+    # pipe that Tk watches to wake it up and let the Python handler run.
+    signal_r, signal_w = os.pipe()
+    os.set_blocking(signal_w, False)
+    signal.set_wakeup_fd(signal_w)
+    root.createfilehandler(signal_r, tk.READABLE, lambda fd, mask: os.read(fd, 512))
+    signal.signal(signal.SIGINT, lambda signum, frame: root.quit())
 
     img = ImageTk.PhotoImage(Image.open(os.path.join(cur_dir, "insta_overlay.png")))
     insta_frame = tk.Label(root, image=img)
     insta_frame.place(x=0, y=0, width=1080, height=1920)
 
     insta_photo = tk.Label(root)
-    insta_photo.place(x=59, y=166, width=951, height=1268)
+    insta_photo.place(x=59, y=166, width=PHOTO_SIZE[0], height=PHOTO_SIZE[1])
 
     event_handler = Handler()
 
@@ -70,4 +108,5 @@ if __name__ == '__main__':
     finally:
         observer.stop()
         observer.join()
+        event_handler.decoder.shutdown()
         display_on()